@@ -0,0 +1 @@
+# keeps the repository root importable for the tests, modules are imported as extract.*, connection.*
@@ -6,7 +6,17 @@ from connection import connection
 import requests
 import json
 import multiprocessing
-from datetime import datetime
+import numbers
+import queue
+import random
+import time
+from collections import deque
+from datetime import datetime, timezone
+from decimal import Decimal
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote
+
+THROTTLE_STATUS_CODES = (429, 503)
 
 
 def get_max_value(config):
@@ -14,7 +24,6 @@ def get_max_value(config):
     schema = config["schema"]
     table = config["table"]
     max_value = config["max_value"]
-    total_value = config["total_value"]
     with open("connection/db_config.yaml", "r") as stream:
         conn_config = yaml.safe_load(stream)[config["dwh_connection"]]
     with connection.get_connection(conn_config) as conn:
@@ -23,41 +32,314 @@ def get_max_value(config):
             max_value = cur.fetchall()[0][0] or config["default_max_value"]
     return max_value
 
-def get_response(config, start_at, max_results, max_value):
-    url = config["url"].format(start_at = start_at,
-                     max_results = max_results,
-                     max_value = max_value)
-    response = requests.get(url, headers = config["headers"])
-    return json.loads(response.text)
-
-def process_part(start_at, config, return_dict, max_value, sema):
-    response_json = get_response(config, start_at, config["max_results"], max_value)
-    return_dict[start_at] = pd.json_normalize(response_json[config["entries"]])
-    print(start_at)
-    print(datetime.now())
-    sema.release()
+def get_retry_after(response):
+    # Retry-After is either a number of seconds or an HTTP date
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+def get_backoff(config, attempt, retry_after = None):
+    # the server knows best when it is ready again, retrying earlier only burns an attempt
+    if retry_after is not None:
+        return retry_after
+    backoff = min(config["backoff_base"] * 2 ** (attempt - 1), config["backoff_max"])
+    return backoff * random.uniform(0.5, 1.0)
+
+def get_path(data, path):
+    for part in path.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
+
+def request_page(config, params, max_value):
+    # a next-link pagination hands us the full url of the following page, cursors and
+    # keyset bounds are query values and may contain reserved characters like + / =
+    if params.get("url"):
+        url = params["url"]
+    else:
+        url = config["url"].format(max_results = config["max_results"],
+                         max_value = max_value,
+                         **{key: quote(str(value), safe = "") for key, value in params.items()})
+    return requests.get(url, headers = config["headers"], timeout = config["request_timeout"])
+
+def process_part(key, params, config, return_dict, max_value, result_queue):
+    # Reports (key, status, latency, retry_after, error, retryable, info) to the scheduler
+    # as soon as the page is read, so the following pages can be requested while this one
+    # is still being normalized. status is None if no HTTP response was received.
+    # latency only covers the request itself, parsing is local work the server is not to blame for
+    started = time.monotonic()
+    latency = 0.0
+    try:
+        response = request_page(config, params, max_value)
+        latency = time.monotonic() - started
+        status = response.status_code
+        if status != 200:
+            retryable = status in THROTTLE_STATUS_CODES or status >= 500
+            result_queue.put((key, status, latency, get_retry_after(response), f"HTTP {status}", retryable, None))
+            return
+        response_json = json.loads(response.text)
+        entries = get_path(response_json, config["entries"]) or []
+        info = {"count": len(entries),
+                "total": get_path(response_json, config["total_value"]) if "total_value" in config else None,
+                "next": get_path(response_json, config["next_value"]) if "next_value" in config else None}
+    except (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema) as e:
+        result_queue.put((key, None, latency, None, repr(e), False, None))
+        return
+    except (requests.RequestException, json.JSONDecodeError) as e:
+        # includes broken or truncated bodies, which are common under load
+        result_queue.put((key, None, latency or time.monotonic() - started, None, repr(e), True, None))
+        return
+    except Exception as e:
+        result_queue.put((key, None, latency, None, repr(e), False, None))
+        return
+    result_queue.put((key, status, latency, None, None, False, info))
+    return_dict[key] = pd.json_normalize(entries)
+
+def get_slices(config, max_value):
+    # keyset pagination splits the watermark range [max_value, keyset_upper_value)
+    # into slices which are paginated independently and in parallel
+    if config["pagination"] != "keyset":
+        return [{"lower": max_value, "upper": None}]
+    slices = config["keyset_slices"]
+    upper_value = config.get("keyset_upper_value")
+    if isinstance(max_value, numbers.Number):
+        if upper_value is None:
+            raise ValueError("keyset_upper_value is required for numeric watermarks")
+        # numeric columns come back as Decimal, which does not mix with float
+        if isinstance(max_value, Decimal) or isinstance(upper_value, Decimal):
+            max_value, upper_value = Decimal(str(max_value)), Decimal(str(upper_value))
+        if max_value >= upper_value:
+            raise ValueError(f"Watermark {max_value} has reached keyset_upper_value {upper_value}")
+        # integer bounds stay exact beyond float precision
+        if isinstance(max_value, int) and isinstance(upper_value, int):
+            bounds = [max_value + (upper_value - max_value) * i // slices for i in range(slices + 1)]
+        else:
+            bounds = [max_value + (upper_value - max_value) * i / slices for i in range(slices + 1)]
+    else:
+        lower = pd.Timestamp(max_value)
+        upper = pd.Timestamp(upper_value) if upper_value is not None else pd.Timestamp.now(tz = lower.tz)
+        if lower.tz is not None and upper.tz is None:
+            upper = upper.tz_localize(lower.tz)
+        elif lower.tz is None and upper.tz is not None:
+            upper = upper.tz_localize(None)
+        if lower >= upper:
+            raise ValueError(f"Watermark {lower} has reached keyset_upper_value {upper}")
+        bounds = [(lower + (upper - lower) * i / slices).strftime(config["keyset_format"]) for i in range(slices + 1)]
+    bounds = list(dict.fromkeys(bounds))
+    if len(bounds) == 1:
+        bounds.append(bounds[0])
+    return [{"lower": bounds[i], "upper": bounds[i + 1]} for i in range(len(bounds) - 1)]
+
+def get_page_pagination(config):
+    pagination = config["keyset_pagination"] if config["pagination"] == "keyset" else config["pagination"]
+    if pagination not in ("offset", "cursor"):
+        raise ValueError(f"Unknown pagination: {pagination}")
+    if pagination == "cursor" and "next_value" not in config:
+        raise ValueError("next_value is required for cursor pagination")
+    return pagination
+
+def page_params(chain, **params):
+    return {"lower": chain["lower"], "upper": chain["upper"]} | params
+
+def first_pages(config, chain):
+    if get_page_pagination(config) == "cursor":
+        chain["scheduled"].add(config["first_cursor"])
+        return [(0, page_params(chain, cursor = config["first_cursor"]))]
+    # without a total in the response we prefetch a window of pages ahead
+    indexes = [0] if "total_value" in config else range(config["prefetch"])
+    chain["scheduled"].update(indexes)
+    return [(i, page_params(chain, start_at = i * config["max_results"])) for i in indexes]
+
+def next_pages(config, chain, index, info):
+    if get_page_pagination(config) == "cursor":
+        if not info["next"]:
+            return []
+        if info["next"] in chain["scheduled"]:
+            raise RuntimeError(f"Cursor {info['next']} was already requested, the server is looping")
+        chain["scheduled"].add(info["next"])
+        if config["next_link"]:
+            return [(index + 1, page_params(chain, url = info["next"]))]
+        return [(index + 1, page_params(chain, cursor = info["next"]))]
+    # the first total seen fixes the pages of the chain, otherwise every full page keeps
+    # the following prefetch window scheduled until a short page marks the end
+    if chain["total"] is None and info["total"] is not None:
+        chain["total"] = info["total"]
+        indexes = range(-(-info["total"] // config["max_results"]))
+    elif chain["total"] is not None:
+        return []
+    elif info["count"] < config["max_results"]:
+        chain["end"] = index if chain["end"] is None else min(chain["end"], index)
+        return []
+    else:
+        indexes = range(index + 1, index + config["prefetch"] + 1)
+    indexes = [i for i in indexes if i not in chain["scheduled"] and (chain["end"] is None or i <= chain["end"])]
+    chain["scheduled"].update(indexes)
+    return [(i, page_params(chain, start_at = i * config["max_results"])) for i in indexes]
+
+def get_controller(config):
+    return {"concurrency": config["concurrency"],
+            "min_concurrency": config["min_concurrency"],
+            "max_concurrency": config["max_concurrency"],
+            "target_latency": config["target_latency"],
+            "latency_factor": config["latency_factor"],
+            "baseline_latency": None,
+            "paused_until": 0.0,
+            "decreased_at": 0.0,
+            "successes": 0}
+
+def decrease_concurrency(controller, launched, concurrency):
+    # a congestion event shows up in every request that was in flight, so only
+    # requests launched after the last decrease may decrease again
+    if launched < controller["decreased_at"]:
+        return
+    controller["concurrency"] = max(controller["min_concurrency"], concurrency)
+    controller["decreased_at"] = time.monotonic()
+    controller["successes"] = 0
+
+def record_success(controller, latency, launched):
+    # additive increase after a full window of fast pages, decrease when a page is much
+    # slower than the fastest one seen, target_latency keeps jitter on fast apis out
+    if controller["baseline_latency"] is None or latency < controller["baseline_latency"]:
+        controller["baseline_latency"] = latency
+    if latency > max(controller["target_latency"], controller["baseline_latency"] * controller["latency_factor"]):
+        decrease_concurrency(controller, launched, controller["concurrency"] - 1)
+        return
+    controller["successes"] += 1
+    if controller["successes"] >= controller["concurrency"]:
+        controller["concurrency"] = min(controller["max_concurrency"], controller["concurrency"] + 1)
+        controller["successes"] = 0
+
+def record_slowdown(controller, launched):
+    # timeouts and server errors mean the server is struggling, back off without a pause
+    decrease_concurrency(controller, launched, controller["concurrency"] // 2)
+
+def record_throttle(controller, pause, launched):
+    # multiplicative decrease and hold off new requests until the server is ready
+    decrease_concurrency(controller, launched, controller["concurrency"] // 2)
+    controller["paused_until"] = max(controller["paused_until"], time.monotonic() + pause)
+
+def stop_processes(processes):
+    for proc in processes:
+        proc.terminate()
+        proc.join()
+
+def reap_finishing(finishing):
+    # workers that already reported their page are still normalizing it
+    for key, proc in list(finishing.items()):
+        if proc.exitcode is None:
+            continue
+        proc.join()
+        del finishing[key]
+        if proc.exitcode != 0:
+            raise RuntimeError(f"Page {key} was fetched but could not be normalized")
 
 def rest_extract(config):
     max_value = get_max_value(config)
-    response_json = get_response(config = config, start_at = 0, max_results = 1, max_value = max_value)
-    start_points = range(0,response_json[config["total_value"]],config["max_results"])
 
     manager = multiprocessing.Manager()
-    concurrency = 10
-    sema = multiprocessing.Semaphore(concurrency)
     return_dict = manager.dict()
-    jobs = []
-    for i in start_points:
-        sema.acquire()
-        p = multiprocessing.Process(target=process_part, args=(i, config, return_dict, max_value, sema))
-        jobs.append(p)
-        p.start()
-    for proc in jobs:
+    result_queue = manager.Queue()
+    controller = get_controller(config)
+    chains = [part | {"scheduled": set(), "end": None, "total": None} for part in get_slices(config, max_value)]
+    pending = deque()
+    attempts = dict()
+    running = dict()
+    finishing = dict()
+    done = []
+    retries = 0
+    started = time.monotonic()
+
+    def schedule(chain_id, pages):
+        for index, params in pages:
+            attempts[(chain_id, index)] = 0
+            pending.append(((chain_id, index), params, 0.0))
+
+    def handle_result(key, status, latency, retry_after, error, retryable, info):
+        nonlocal retries
+        proc, params, launched = running.pop(key)
+        if status == 200:
+            finishing[key] = proc
+            done.append(key)
+            schedule(key[0], next_pages(config, chains[key[0]], key[1], info))
+            record_success(controller, latency, launched)
+            print(f"{key} done in {latency:.2f}s, concurrency {controller['concurrency']}")
+            return
         proc.join()
+        attempts[key] += 1
+        pause = get_backoff(config, attempts[key], retry_after)
+        if status in THROTTLE_STATUS_CODES:
+            record_throttle(controller, pause, launched)
+        elif retryable:
+            record_slowdown(controller, launched)
+        if not retryable:
+            raise RuntimeError(f"Page {key} failed: {error}")
+        if attempts[key] > config["max_retries"]:
+            raise RuntimeError(f"Page {key} failed after {attempts[key]} attempts: {error}")
+        retries += 1
+        print(f"{key} failed ({error}), retry in {pause:.1f}s, concurrency {controller['concurrency']}")
+        pending.append((key, params, time.monotonic() + pause))
+
+    # workers still normalizing a page hold its response in memory, so they count
+    # against max_concurrency plus a small margin as well
+    max_workers = controller["max_concurrency"] + config["normalize_margin"]
+    try:
+        for chain_id, chain in enumerate(chains):
+            schedule(chain_id, first_pages(config, chain))
 
-    df_out = pd.DataFrame()
-    for key in return_dict.keys():
-        df_out = df_out.append(return_dict[key], ignore_index=True)
+        while pending or running:
+            reap_finishing(finishing)
+            now = time.monotonic()
+            if now >= controller["paused_until"]:
+                for _ in range(len(pending)):
+                    if len(running) >= controller["concurrency"] or len(running) + len(finishing) >= max_workers:
+                        break
+                    key, params, ready_at = pending.popleft()
+                    if ready_at > now:
+                        pending.append((key, params, ready_at))
+                        continue
+                    p = multiprocessing.Process(target=process_part, args=(key, params, config, return_dict, max_value, result_queue))
+                    running[key] = (p, params, time.monotonic())
+                    p.start()
+            try:
+                handle_result(*result_queue.get(timeout = 0.1))
+                continue
+            except queue.Empty:
+                pass
+            crashed = [key for key, (proc, _, _) in running.items() if proc.exitcode is not None]
+            if crashed:
+                while True:
+                    try:
+                        handle_result(*result_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for key in crashed:
+                    if key in running:
+                        handle_result(key, None, 0.0, None, f"process exited with {running[key][0].exitcode}", False, None)
+
+        while finishing:
+            reap_finishing(finishing)
+            time.sleep(0.1)
+    except BaseException:
+        stop_processes([proc for proc, _, _ in running.values()] + list(finishing.values()))
+        raise
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    df_out = pd.concat([return_dict[key] for key in sorted(done)], ignore_index=True) \
+        if done else pd.DataFrame()
+    print(f"Extracted {len(df_out)} rows in {len(done)} pages in {elapsed:.1f}s "
+          f"({len(df_out) / elapsed:.1f} rows/s, {len(done) / elapsed:.2f} pages/s), "
+          f"{retries} retries, final concurrency {controller['concurrency']}")
+    print(datetime.now())
     return df_out
 
 
@@ -66,4 +348,4 @@ def extract(config):
         max_value = get_max_value(config)
     if config["output"] == "pandas_df":
         df_out = rest_extract(config)
-        return df_out
\ No newline at end of file
+        return df_out
@@ -0,0 +1,189 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from types import SimpleNamespace
+
+import pytest
+
+from extract import rest_extract_module as rest
+
+
+def get_config(**config):
+    return {"concurrency": 8,
+            "min_concurrency": 1,
+            "max_concurrency": 10,
+            "target_latency": 1,
+            "latency_factor": 3,
+            "backoff_base": 1,
+            "backoff_max": 60} | config
+
+
+def test_retry_after_seconds():
+    assert rest.get_retry_after(SimpleNamespace(headers={"Retry-After": "120"})) == 120
+
+
+def test_retry_after_http_date():
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    retry_after = rest.get_retry_after(SimpleNamespace(headers={"Retry-After": format_datetime(retry_at, usegmt=True)}))
+    assert 25 < retry_after <= 30
+
+
+def test_retry_after_missing_or_invalid():
+    assert rest.get_retry_after(SimpleNamespace(headers={})) is None
+    assert rest.get_retry_after(SimpleNamespace(headers={"Retry-After": "soon"})) is None
+
+
+def test_backoff_honours_retry_after_above_cap():
+    assert rest.get_backoff(get_config(), 1, retry_after=120) == 120
+
+
+def test_backoff_grows_and_is_capped():
+    config = get_config()
+    assert 0.5 <= rest.get_backoff(config, 1) <= 1
+    assert 4 <= rest.get_backoff(config, 4) <= 8
+    assert 30 <= rest.get_backoff(config, 20) <= 60
+
+
+def test_additive_increase_after_full_window():
+    controller = rest.get_controller(get_config())
+    for _ in range(7):
+        rest.record_success(controller, 0.5, launched=0.0)
+    assert controller["concurrency"] == 8
+    rest.record_success(controller, 0.5, launched=0.0)
+    assert controller["concurrency"] == 9
+
+
+def test_increase_stops_at_max_concurrency():
+    controller = rest.get_controller(get_config(concurrency=10))
+    for _ in range(20):
+        rest.record_success(controller, 0.5, launched=0.0)
+    assert controller["concurrency"] == 10
+
+
+def test_slow_page_compares_against_baseline():
+    controller = rest.get_controller(get_config())
+    rest.record_success(controller, 6.0, launched=0.0)
+    rest.record_success(controller, 15.0, launched=0.0)
+    assert controller["concurrency"] == 8
+    rest.record_success(controller, 20.0, launched=0.0)
+    assert controller["concurrency"] == 7
+
+
+def test_throttle_halves_once_per_event_and_pauses():
+    controller = rest.get_controller(get_config())
+    launched = rest.time.monotonic()
+    for _ in range(8):
+        rest.record_throttle(controller, 5, launched)
+    assert controller["concurrency"] == 4
+    assert controller["paused_until"] >= launched + 5
+    rest.record_throttle(controller, 5, rest.time.monotonic())
+    assert controller["concurrency"] == 2
+
+
+def test_decrease_stops_at_min_concurrency():
+    controller = rest.get_controller(get_config(concurrency=1))
+    rest.record_slowdown(controller, rest.time.monotonic())
+    assert controller["concurrency"] == 1
+
+
+def get_pagination_config(**config):
+    return {"pagination": "offset",
+            "keyset_pagination": "offset",
+            "max_results": 5,
+            "prefetch": 3,
+            "first_cursor": "",
+            "next_link": False,
+            "keyset_slices": 4,
+            "keyset_format": "%Y-%m-%d %H:%M"} | config
+
+
+def get_chain(lower=None, upper=None):
+    return {"lower": lower, "upper": upper, "scheduled": set(), "end": None, "total": None}
+
+
+def get_info(count=5, total=None, next=None):
+    return {"count": count, "total": total, "next": next}
+
+
+def test_offset_with_total_schedules_all_pages():
+    config = get_pagination_config(total_value="total")
+    chain = get_chain()
+    assert [i for i, _ in rest.first_pages(config, chain)] == [0]
+    pages = rest.next_pages(config, chain, 0, get_info(total=23))
+    assert [i for i, _ in pages] == [1, 2, 3, 4]
+    assert [params["start_at"] for _, params in pages] == [5, 10, 15, 20]
+    assert rest.next_pages(config, chain, 1, get_info(total=23)) == []
+
+
+def test_offset_with_missing_total_fills_prefetch_window():
+    config = get_pagination_config(total_value="total")
+    chain = get_chain()
+    rest.first_pages(config, chain)
+    assert [i for i, _ in rest.next_pages(config, chain, 0, get_info())] == [1, 2, 3]
+    assert [i for i, _ in rest.next_pages(config, chain, 1, get_info())] == [4]
+
+
+def test_offset_without_total_stops_at_short_page():
+    config = get_pagination_config()
+    chain = get_chain()
+    assert [i for i, _ in rest.first_pages(config, chain)] == [0, 1, 2]
+    assert rest.next_pages(config, chain, 2, get_info(count=3)) == []
+    assert rest.next_pages(config, chain, 0, get_info()) == []
+    assert chain["end"] == 2
+
+
+def test_cursor_requires_next_value():
+    with pytest.raises(ValueError):
+        rest.first_pages(get_pagination_config(pagination="cursor"), get_chain())
+
+
+def test_cursor_follows_tokens_and_detects_loops():
+    config = get_pagination_config(pagination="cursor", next_value="next")
+    chain = get_chain()
+    assert rest.first_pages(config, chain)[0][1]["cursor"] == ""
+    assert rest.next_pages(config, chain, 0, get_info(next="a+b=")) == [(1, {"lower": None, "upper": None, "cursor": "a+b="})]
+    assert rest.next_pages(config, chain, 1, get_info(next=None)) == []
+    with pytest.raises(RuntimeError):
+        rest.next_pages(config, chain, 1, get_info(next="a+b="))
+
+
+def test_cursor_next_link_is_used_as_url():
+    config = get_pagination_config(pagination="cursor", next_value="next", next_link=True)
+    chain = get_chain()
+    rest.first_pages(config, chain)
+    assert rest.next_pages(config, chain, 0, get_info(next="https://api/page2"))[0][1]["url"] == "https://api/page2"
+
+
+def test_request_page_encodes_params_but_not_next_link(monkeypatch):
+    monkeypatch.setattr(rest.requests, "get", lambda url, **kwargs: url)
+    config = {"url": "https://api/?cursor={cursor}&n={max_results}", "max_results": 5, "headers": {}, "request_timeout": 1}
+    assert rest.request_page(config, {"cursor": "tok+1/="}, None) == "https://api/?cursor=tok%2B1%2F%3D&n=5"
+    assert rest.request_page(config, {"url": "https://api/?cursor=tok+1"}, None) == "https://api/?cursor=tok+1"
+
+
+def test_slices_cover_integer_range_exactly():
+    config = get_pagination_config(pagination="keyset", keyset_upper_value=2**60 + 8)
+    slices = rest.get_slices(config, 2**60)
+    assert [part["lower"] for part in slices] == [2**60, 2**60 + 2, 2**60 + 4, 2**60 + 6]
+    assert slices[-1]["upper"] == 2**60 + 8
+
+
+def test_slices_reject_exhausted_upper_value():
+    with pytest.raises(ValueError):
+        rest.get_slices(get_pagination_config(pagination="keyset", keyset_upper_value=100), 150)
+
+
+def test_slices_mix_decimal_and_float():
+    slices = rest.get_slices(get_pagination_config(pagination="keyset", keyset_upper_value=9.5), rest.Decimal("1.5"))
+    assert [part["lower"] for part in slices] == [rest.Decimal("1.5"), rest.Decimal("3.5"), rest.Decimal("5.5"), rest.Decimal("7.5")]
+
+
+def test_slices_of_tz_aware_watermark_end_now():
+    lower = datetime.now(timezone.utc) - timedelta(days=4)
+    slices = rest.get_slices(get_pagination_config(pagination="keyset"), lower)
+    assert len(slices) == 4
+    assert slices[0]["lower"] == lower.strftime("%Y-%m-%d %H:%M")
+    assert all(part["lower"] < part["upper"] for part in slices)
+
+
+def test_without_keyset_there_is_one_slice():
+    assert rest.get_slices(get_pagination_config(), "2024-01-01") == [{"lower": "2024-01-01", "upper": None}]